@@ -1,189 +1,202 @@
-#!/usr/bin/env python
+#!/usr/bin/env python3
 import sys
 import os
 import re
-import commands
+import mmap
+import plistlib
 import subprocess
 import argparse
-import inspect
+from collections import namedtuple
 from datetime import date
 
+
+# Matches each of the version fields of an xml .plist, e.g.:
+#
+# <key>CFBundleVersion</key>
+# <string>3</string>
+_PLIST_VERSION_RE = re.compile(rb'<key>(CFBundleShortVersionString|CFBundleVersion|OWSBundleVersion4)</key>\s*<string>([\d\.]+)</string>', re.MULTILINE)
+
+
 def fail(message):
     file_name = __file__
-    current_line_no = inspect.stack()[1][2]
-    current_function_name = inspect.stack()[1][3]
-    print 'Failure in:', file_name, current_line_no, current_function_name
-    print message
+    caller_frame = sys._getframe(1)
+    current_line_no = caller_frame.f_lineno
+    current_function_name = caller_frame.f_code.co_name
+    print('Failure in:', file_name, current_line_no, current_function_name)
+    print(message)
     sys.exit(1)
 
 
 def execute_command(command):
     try:
-        print ' '.join(command)
-        output = subprocess.check_output(command)
+        print(' '.join(command))
+        output = subprocess.check_output(command, text=True)
         if output:
-            print output
+            print(output)
     except subprocess.CalledProcessError as e:
-        print e.output
+        print(e.output)
         sys.exit(1)
 
 
 def find_project_root():
-    path = os.path.abspath(os.curdir)
-
-    while True:
-        # print 'path', path
-        if not os.path.exists(path):
-            break
-        git_path = os.path.join(path, '.git')
-        if os.path.exists(git_path):
-            return path
-        new_path = os.path.abspath(os.path.dirname(path))
-        if not new_path or new_path == path:
-            break
-        path = new_path
-
-    fail('Could not find project root path')
-
-
-def is_valid_version_1(value):
-    regex = re.compile(r'^(\d+)$')
-    match = regex.search(value)
-    return match is not None
-
-
-def is_valid_version_3(value):
-    regex = re.compile(r'^(\d+)\.(\d+)\.(\d+)$')
-    match = regex.search(value)
-    return match is not None
-
-
-def is_valid_version_4(value):
-    regex = re.compile(r'^(\d+)\.(\d+)\.(\d+).(\d+)$')
-    match = regex.search(value)
-    return match is not None
-
-
-def set_versions(plist_file_path, release_version, build_version_1, build_version_4):
-    if not is_valid_version_3(release_version):
-        fail('Invalid release version: %s' % release_version)
-    if not is_valid_version_1(build_version_1):
-        fail('Invalid build version 1: %s' % build_version_1)
-    if not is_valid_version_4(build_version_4):
-        fail('Invalid build version 4: %s' % build_version_4)
-
-    with open(plist_file_path, 'rt') as f:
-        text = f.read()
-    # print 'text', text
-
-    # CFBundleShortVersionString is the release version.
-    #
-    # <key>CFBundleShortVersionString</key>
-    # <string>2.20.0</string>
-    file_regex = re.compile(r'<key>CFBundleShortVersionString</key>\s*<string>([\d\.]+)</string>', re.MULTILINE)
-    file_match = file_regex.search(text)
-    # print 'match', match
-    if not file_match:
-        fail('Could not parse .plist')
-    text = text[:file_match.start(1)] + release_version + text[file_match.end(1):]
-
-    # CFBundleVersion is the build version 1.
-    #
-    # <key>CFBundleVersion</key>
-    # <string>3</string>
-    file_regex = re.compile(r'<key>CFBundleVersion</key>\s*<string>([\d\.]+)</string>', re.MULTILINE)
-    file_match = file_regex.search(text)
-    # print 'match', match
-    if not file_match:
-        fail('Could not parse .plist')
-    text = text[:file_match.start(1)] + build_version_1 + text[file_match.end(1):]
-
-    # The build version 4.
-    #
-    # <key>OWSBundleVersion4</key>
-    # <string>2.20.0.3</string>
-    file_regex = re.compile(r'<key>OWSBundleVersion4</key>\s*<string>([\d\.]+)</string>', re.MULTILINE)
-    file_match = file_regex.search(text)
-    # print 'match', match
-    if not file_match:
+    try:
+        return subprocess.check_output(['git', 'rev-parse', '--show-toplevel'], text=True).strip()
+    except subprocess.CalledProcessError:
+        fail('Could not find project root path')
+
+
+# Parses a version string with `count` dotted values, e.g. 1.2.3 -> (1, 2, 3).
+#
+# Returns None if the string is not in canonical form, i.e. if it has the wrong
+# number of values or any value is empty, non-numeric or has leading zeros.
+def _parse_dotted(text, count):
+    parts = text.split('.')
+    if len(parts) != count:
+        return None
+    for part in parts:
+        if not (part.isascii() and part.isdigit()) or (part != '0' and part.startswith('0')):
+            return None
+    return tuple(int(part) for part in parts)
+
+
+def is_xml_plist(plist_file_path):
+    with open(plist_file_path, 'rb') as f:
+        return f.read(1) == b'<'
+
+
+# Ensures that the .plists are in xml format, not binary.
+#
+# plutil is only launched for .plists that need converting, and those
+# conversions run concurrently.
+def convert_plists_to_xml(plist_file_paths):
+    processes = []
+    for plist_file_path in plist_file_paths:
+        if is_xml_plist(plist_file_path):
+            continue
+        command = ['plutil', '-convert', 'xml1', plist_file_path]
+        print(' '.join(command))
+        processes.append(subprocess.Popen(command))
+    for process in processes:
+        if process.wait() != 0:
+            fail('Could not convert .plist to xml')
+
+
+def load_plist_data(plist_file_path):
+    with open(plist_file_path, 'rb') as f:
+        return f.read()
+
+
+# The version fields of a .plist and the number of dotted values in each.
+#
+# CFBundleShortVersionString is the release version,
+# CFBundleVersion is the build version 1 and
+# OWSBundleVersion4 is the build version 4.
+_PLIST_VERSION_FIELDS = {
+    'CFBundleShortVersionString': 3,
+    'CFBundleVersion': 1,
+    'OWSBundleVersion4': 4,
+}
+
+
+# Finds the version fields of a .plist that need to change.
+#
+# Returns a list of (start, end, value) tuples with the byte range of each old
+# value and its replacement. Fields that are not in new_values, or that already
+# have the new value, are skipped.
+def find_version_edits(data, new_values):
+    for key, value in new_values.items():
+        if _parse_dotted(value, _PLIST_VERSION_FIELDS[key]) is None:
+            fail('Invalid %s: %s' % (key, value))
+
+    found_keys = []
+    edits = []
+    for match in _PLIST_VERSION_RE.finditer(data):
+        key = match.group(1).decode('ascii')
+        if key not in new_values:
+            continue
+        found_keys.append(key)
+        value = new_values[key].encode('ascii')
+        if match.group(2) != value:
+            edits.append((match.start(2), match.end(2), value))
+    if sorted(found_keys) != sorted(new_values.keys()):
         fail('Could not parse .plist')
-    text = text[:file_match.start(1)] + build_version_4 + text[file_match.end(1):]
 
-    with open(plist_file_path, 'wt') as f:
-        f.write(text)
+    return edits
+
+
+# Returns the contents of a .plist with the given edits applied.
+def apply_version_edits(data, edits):
+    parts = []
+    position = 0
+    for start, end, value in edits:
+        parts.append(data[position:start])
+        parts.append(value)
+        position = end
+    parts.append(data[position:])
+    return b''.join(parts)
+
+
+# Updates the given version fields of a .plist.
+#
+# If every new value has the same length as the value it replaces (e.g. when
+# bumping the build from 42 to 43), the values are overwritten in place.
+# Otherwise the file is rewritten.
+def set_versions(plist_file_path, new_values):
+    with open(plist_file_path, 'r+b') as f:
+        with mmap.mmap(f.fileno(), 0) as data:
+            edits = find_version_edits(data, new_values)
+            if all(end - start == len(value) for start, end, value in edits):
+                for start, end, value in edits:
+                    data[start:end] = value
+                data.flush()
+                return
+            new_data = apply_version_edits(data, edits)
+
+        f.seek(0)
+        f.write(new_data)
+        f.truncate()
 
 
 # Represents a version string with 1 values, e.g. 1.
-class Version1:
-    def __init__(self, build):
-        self.build = build
-        
+class Version1(namedtuple('Version1', ['build'])):
+    __slots__ = ()
+
     def formatted(self):
         return str(self.build)
 
 
-
 # Represents a version string with 3 dotted values, e.g. 1.2.3.
-class Version3:
-    def __init__(self, major, minor, patch):
-        self.major = major
-        self.minor = minor
-        self.patch = patch
-        
+class Version3(namedtuple('Version3', ['major', 'minor', 'patch'])):
+    __slots__ = ()
+
     def formatted(self):
-        return str(self.major) + "." + str(self.minor) + "." + str(self.patch)
+        return f'{self.major}.{self.minor}.{self.patch}'
 
 
 # Represents a version string with 4 dotted values, e.g. 1.2.3.4.
-class Version4:
-    def __init__(self, major, minor, patch, build):
-        self.major = major
-        self.minor = minor
-        self.patch = patch
-        self.build = build
-        
+class Version4(namedtuple('Version4', ['major', 'minor', 'patch', 'build'])):
+    __slots__ = ()
+
     def formatted(self):
-        return str(self.major) + "." + str(self.minor) + "." + str(self.patch) + "." + str(self.build)
+        return f'{self.major}.{self.minor}.{self.patch}.{self.build}'
 
 
 def parse_version_3(text):
-   # print 'text', text
-   regex = re.compile(r'^(\d+)\.(\d+)\.(\d+)$')
-   match = regex.search(text)
-   # print 'match', match
-   if not match:
-       fail('Could not parse .plist')
-   if len(match.groups()) != 3:
+   values = _parse_dotted(text, 3)
+   if values is None:
        fail('Could not parse .plist')
-   major = int(match.group(1))
-   minor = int(match.group(2))
-   patch = int(match.group(3))
-
-   version = Version3(major, minor, patch)
-   
-   # Verify that roundtripping yields the same value.
-   if version.formatted() != text:
-       fail('Could not parse .plist')
-   
-   return version
+   return Version3(*values)
 
 
 def parse_version_1(text):
-   build = int(text)
-
-   version = Version1(build)
-   
-   # Verify that roundtripping yields the same value.
-   if version.formatted() != text:
+   values = _parse_dotted(text, 1)
+   if values is None:
        fail('Could not parse .plist')
-   
-   return version
+   return Version1(*values)
 
 
-def get_versions(plist_file_path):
-    with open(plist_file_path, 'rt') as f:
-        text = f.read()
-    # print 'text', text
+def get_versions(data):
+    plist = plistlib.loads(data)
 
     # CFBundleShortVersionString identifies the release track.
     # CFBundleVersion uniqely identifies the build within the release track.
@@ -209,27 +222,21 @@ def get_versions(plist_file_path):
     # * https://developer.apple.com/documentation/bundleresources/information_property_list/cfbundleshortversionstring
     # * https://developer.apple.com/documentation/bundleresources/information_property_list/cfbundleversion
     # * https://developer.apple.com/library/archive/technotes/tn2420/_index.html
-    release_version_regex = re.compile(r'<key>CFBundleShortVersionString</key>\s*<string>(\d+\.\d+\.\d+)</string>', re.MULTILINE)
-    release_version_match = release_version_regex.search(text)
-    # print 'match', match
-    if not release_version_match:
+    release_version_str = plist.get('CFBundleShortVersionString')
+    if not release_version_str:
         fail('Could not parse .plist')
 
-    build_version_1_regex = re.compile(r'<key>CFBundleVersion</key>\s*<string>(\d+)</string>', re.MULTILINE)
-    build_version_1_match = build_version_1_regex.search(text)
-    # print 'match', match
-    if not build_version_1_match:
+    build_version_1_str = plist.get('CFBundleVersion')
+    if not build_version_1_str:
         fail('Could not parse .plist')
 
-    release_version_str = release_version_match.group(1)
-    print 'CFBundleShortVersionString:', release_version_str
+    print('CFBundleShortVersionString:', release_version_str)
     release_version = parse_version_3(release_version_str)
-    print 'old_release_version:', release_version.formatted()
+    print('old_release_version:', release_version.formatted())
 
-    build_version_1_str = build_version_1_match.group(1)
-    print 'CFBundleVersion:', build_version_1_str
+    print('CFBundleVersion:', build_version_1_str)
     build_version_1 = parse_version_1(build_version_1_str)
-    print 'old_build_version_1:', build_version_1.formatted()
+    print('old_build_version_1:', build_version_1.formatted())
 
     return release_version, build_version_1
 
@@ -250,7 +257,7 @@ if __name__ == '__main__':
     is_beta = args.beta
 
     project_root_path = find_project_root()
-    # print 'project_root_path', project_root_path
+    # print('project_root_path', project_root_path)
     # plist_path
     main_plist_path = os.path.join(project_root_path, 'Signal', 'Signal-Info.plist')
     if not os.path.exists(main_plist_path):
@@ -264,39 +271,31 @@ if __name__ == '__main__':
     if not os.path.exists(nse_plist_path):
         fail('Could not find NSE info .plist')
 
-    output = subprocess.check_output(['git', 'status', '--porcelain'])
+    # --porcelain reports staged, unstaged and untracked changes alike.
+    output = subprocess.check_output(['git', 'status', '--porcelain'], text=True)
     if len(output.strip()) > 0:
-        print output
-        fail('Git repository has untracked files.')
-    output = subprocess.check_output(['git', 'diff', '--shortstat'])
-    if len(output.strip()) > 0:
-        print output
+        print(output)
         fail('Git repository has untracked files.')
 
-    # Ensure .plist is in xml format, not binary.
     plist_paths = [
         main_plist_path,
         sae_plist_path,
         nse_plist_path,
     ]
-    for plist_path in plist_paths:
-        print 'plist_path:', plist_path
-            
-        output = subprocess.check_output(['plutil', '-convert', 'xml1', plist_path])
-        # print 'output', output
+    convert_plists_to_xml(plist_paths)
 
     # ---------------
     # Main App
     # ---------------
 
-    old_release_version, old_build_version_1 = get_versions(main_plist_path)
+    old_release_version, old_build_version_1 = get_versions(load_plist_data(main_plist_path))
 
     if args.version:
         # Bump version, reset patch to zero.
         #
         # e.g. --version 1.2.3 -> "1.2.3", "102.3.0"
         new_release_version_3 = parse_version_3(args.version.strip())
-        # print 'new_release_version_3:', new_release_version_3.formatted()
+        # print('new_release_version_3:', new_release_version_3.formatted())
         
         new_build_version_1 = Version1(0)
         new_build_version_4 = Version4(
@@ -327,19 +326,25 @@ if __name__ == '__main__':
     # new_release_version_3: 5.19.0
     # new_build_version_1: 43
     # new_build_version_4: 5.19.0.43
-    print 'new_release_version_3:', new_release_version_3
-    print 'new_build_version_1:', new_build_version_1
-    print 'new_build_version_4:', new_build_version_4
+    print('new_release_version_3:', new_release_version_3)
+    print('new_build_version_1:', new_build_version_1)
+    print('new_build_version_4:', new_build_version_4)
+
+    # All plists share the main app's release version. Fields that already
+    # have the new value are left untouched.
+    new_values = {
+        'CFBundleShortVersionString': new_release_version_3,
+        'CFBundleVersion': new_build_version_1,
+        'OWSBundleVersion4': new_build_version_4,
+    }
 
     for plist_path in plist_paths:
-        set_versions(plist_path, new_release_version_3, new_build_version_1, new_build_version_4)
+        print('plist_path:', plist_path)
+        set_versions(plist_path, new_values)
     
     # ---------------
     # Git
     # ---------------
-    command = ['git', 'add', '.']
-    execute_command(command)
-
     if is_internal:
         commit_message = '"Bump build to %s." (Internal)' % new_build_version_4
     elif is_beta:
@@ -348,7 +353,8 @@ if __name__ == '__main__':
         commit_message = '"Bump build to %s." (nightly-%s)' % ( new_build_version_4, date.today().strftime("%m-%d-%Y") )
     else:
         commit_message = '"Bump build to %s."' % new_build_version_4
-    command = ['git', 'commit', '-m', commit_message]
+    # The working tree was clean, so the only changes are to the tracked .plists.
+    command = ['git', 'commit', '--all', '-m', commit_message]
     execute_command(command)
 
     tag_name = new_build_version_4